@@ -23,10 +23,15 @@
 # IN THE SOFTWARE.
 #
 
-import math
 import argparse
 import json
 import datetime
+import math
+import os
+import concurrent.futures
+import functools
+
+import numpy as np
 
 # This python program is used to generate a C-language thermistor temperature
 # calculation program. It is intended for use by small microcontrollers
@@ -120,32 +125,35 @@ header_close = """#endif
 /** @} */
 """
 
-parms_block = (
-"""/** @addtogroup therm Thermistor
+# render the parameters comment block. this is an f-string so the layout
+# is compiled once with the module instead of parsed on every call
+def render_parms(now, path, board, thermistor, Tstart, Tstop, Tstep,
+                 Tnominal, Rnominal, Rpulldown, beta, counts):
+    return f"""/** @addtogroup therm Thermistor
  *
  * This file was generated by https://github.com/kroesche/thermistor_lookup
  *
- * Generated on {:s},<br/>
+ * Generated on {now:s},<br/>
  * for a thermistor circuit with the following parameters:
  *
  * |Parameter |Value                         |
  * |----------|------------------------------|
- * |Input File|{:<30s}|
- * |Board     |{:<30s}|
- * |Thermistor|{:<30s}|
- * |Tstart    |{:<30d}|
- * |Tstop     |{:<30d}|
- * |Tstep     |{:<30d}|
- * |Tnominal  |{:<30d}|
- * |Rnominal  |{:<30d}|
- * |Rpulldown |{:<30d}|
- * |beta      |{:<30d}|
- * |counts    |{:<30d}|
+ * |Input File|{path:<30s}|
+ * |Board     |{board:<30s}|
+ * |Thermistor|{thermistor:<30s}|
+ * |Tstart    |{Tstart:<30d}|
+ * |Tstop     |{Tstop:<30d}|
+ * |Tstep     |{Tstep:<30d}|
+ * |Tnominal  |{Tnominal:<30d}|
+ * |Rnominal  |{Rnominal:<30d}|
+ * |Rpulldown |{Rpulldown:<30d}|
+ * |beta      |{beta:<30d}|
+ * |counts    |{counts:<30d}|
  *
  * @{{
  */
 
-""")
+"""
 
 function_declaration = (
 """#ifdef __cplusplus
@@ -171,60 +179,264 @@ extern int16_t adc_to_temp(uint16_t adc);
 
 """)
 
-function_definition = (
-"""// Calculate temperature using lookup table.
+selftest_declaration = (
+"""#ifdef __cplusplus
+extern "C" {
+#endif
+
+/**
+ * Check adc_to_temp() against reference test vectors.
+ *
+ * Compares the result of adc_to_temp() for a set of ADC values with the
+ * result expected by the generator. The comparison uses integer math only,
+ * so no floating point support is needed. This function is in
+ * thermistor_testvec.c.
+ *
+ * @return the number of test vectors that are off by more than
+ * THERM_TESTVEC_TOL degrees, 0 if all pass
+ */
+extern int16_t thermistor_selftest(void);
+
+#ifdef __cplusplus
+}
+#endif
+
+""")
+
+testvec_function_definition = (
+"""// Check adc_to_temp() against the test vectors.
 // See header file for API description
-int16_t adc_to_temp(uint16_t adc)
+int16_t thermistor_selftest(void)
 {
-    uint16_t idx;
-    int16_t adc0;
-    int16_t adc1;
-    int16_t temp0 = 0; // prevent g++ warning
+    int16_t failures = 0;
 
-    if (adc < therm_table[0])
+    for (uint16_t idx = 0; idx < T_TESTVEC_COUNT; ++idx)
     {
-        adc0 = therm_table[0];
-        adc1 = therm_table[1];
-        temp0 = T_AT_IDX(0);
+        int32_t err = (int32_t)adc_to_temp(TESTVEC_ADC_AT_IDX(idx))
+                      - TESTVEC_EXPECT_AT_IDX(idx);
+        if ((err > THERM_TESTVEC_TOL) || (err < -THERM_TESTVEC_TOL))
+        {
+            ++failures;
+        }
     }
-    else if (adc >= therm_table[T_LAST_IDX])
+
+    return failures;
+}
+""")
+
+# number of test vectors generated by --emit-testvec
+TESTVEC_POINTS = 32
+
+# function used for larger tables. binary search for the segment that
+# contains the ADC value, so the number of comparisons is log2 of the table
+# size instead of linear
+function_definition = (
+"""// Calculate temperature using lookup table.
+// See header file for API description
+int16_t adc_to_temp(uint16_t adc)
+{{
+    // binary search over the segments, comparing only the interior table
+    // points. values outside the table end up in the first or last segment
+    // without any extra checks
+    uint16_t lo = 0;
+    uint16_t hi = T_LAST_IDX - 1;
+    while (lo < hi)
+    {{
+        uint16_t mid = (lo + hi) >> 1;
+        if (adc < ADC_AT_IDX(mid + 1))
+        {{
+            hi = mid;
+        }}
+        else
+        {{
+            lo = mid + 1;
+        }}
+    }}
+    uint16_t idx = lo;
+
+{:s}}}
+""")
+
+# interpolation used by the table function when segment slopes are not whole
+# numbers. adc_type is the type used for table points, and diff_type is a
+# signed type that holds the difference of two ADC values
+interpolate_recip = (
+"""    // interpolate within the segment. the division by the segment range
+    // is done by multiplying with the precomputed reciprocal and shifting
+    {adc_type:s} adc0 = ADC_AT_IDX(idx);
+    {diff_type:s} range = ADC_AT_IDX(idx + 1) - adc0;
+    {diff_type:s} half_digit = range >> 1;
+    int32_t temp = T_STEP_MUL((int32_t)(({diff_type:s})adc - adc0)) + half_digit;
+    {recip_mul:s}
+
+    return T_AT_IDX(idx) + (int16_t)temp;
+""")
+
+# interpolation used by the table function when every segment slope is a
+# whole number
+interpolate_slope = (
+"""    // every segment has a whole number slope, so the interpolation is
+    // exact and needs only a multiply
+    {diff_type:s} delta = ({diff_type:s})adc - ({diff_type:s})ADC_AT_IDX(idx);
+
+    return T_AT_IDX(idx) + delta * SLOPE_AT_IDX(idx);
+""")
+
+dense_function_definition = (
+"""// Calculate temperature using lookup table.
+// See header file for API description
+int16_t adc_to_temp(uint16_t adc)
+{{
+    return TEMP_AT_ADC({:s});
+}}
+""")
+
+poly_function_definition = (
+"""// Calculate temperature using a fitted polynomial.
+// See header file for API description
+int16_t adc_to_temp(uint16_t adc)
+{{
+{:s}    // Horner evaluation in fixed point. coefficients are scaled by
+    // 2^T_POLY_SHIFT, and the ADC value is treated as a fraction of
+    // 2^T_ADC_BITS
+    int32_t temp = {:s};
+{:s}
+    temp += (int32_t)1 << (T_POLY_SHIFT - 1);
+    return (int16_t)(temp >> T_POLY_SHIFT);
+}}
+""")
+
+# the polynomial is only valid over the fitted range. the input is clamped
+# to it, which also keeps the fixed point values from overflowing
+poly_clamp_low = (
+"""    if (adc < T_ADC_MIN)
     {
-        adc0 = therm_table[T_LAST_IDX - 1];
-        adc1 = therm_table[T_LAST_IDX];
-        temp0 = T_AT_IDX(T_LAST_IDX - 1);
+        adc = T_ADC_MIN;
     }
+""")
 
-    else
+poly_clamp_high = (
+"""    if (adc > T_ADC_MAX)
     {
-        for (idx = 0; idx < T_LAST_IDX; ++idx)
-        {
-            adc0 = therm_table[idx];
-            adc1 = therm_table[idx + 1];
-            if (adc < adc1)
-            {
-                temp0 = T_AT_IDX(idx);
-                break;
-            }
-        }
+        adc = T_ADC_MAX;
     }
+""")
 
-    int16_t delta = (int16_t)adc - adc0;
-    int16_t range = adc1 - adc0;
-    int16_t half_digit = range >> 1;
+# a polynomial is rejected if the fixed point math makes the result worse
+# than the fit error plus rounding to whole degrees, by more than this
+POLY_ERR_MARGIN = 0.1
 
-    int16_t temp = delta * T_STEP + half_digit;
-    temp /= range;
-    temp += temp0;
+# largest shift used for the segment reciprocals
+RECIP_SHIFT_MAX = 31
 
-    return temp;
-}
+# multiply by the segment reciprocal in 32 bits, or in 64 bits when there is
+# no 16-bit reciprocal that gives exact results
+recip_mul = "temp = (temp * RECIP_AT_IDX(idx)) >> RSHIFT_AT_IDX(idx);"
+recip_mul_wide = "temp = (int32_t)(((int64_t)temp * RECIP_AT_IDX(idx)) >> RSHIFT_AT_IDX(idx));"
+
+# tables with this many segments or fewer do not use a search loop. on MCUs
+# without branch prediction or cache (AVR, 8051) the search is unrolled into
+# a tree of compares against constants, with no table at all. on other
+# targets the segment is found with a fixed sequence of compares and no
+# branches. larger tables on those targets are searched in Eytzinger order
+SMALL_TABLE_SEGMENTS = 16
+SMALL_CORE_TARGETS = ("avr", "8051")
+
+eytzinger_function_definition = (
+"""// Calculate temperature using lookup table.
+// See header file for API description
+int16_t adc_to_temp(uint16_t adc)
+{{
+    // search the table points in Eytzinger (breadth first) order. the
+    // points visited first are next to each other in memory, so the search
+    // touches fewer cache lines than a plain binary search
+    uint16_t k = 1;
+    while (k <= T_EYTZ_SIZE)
+    {{
+        k = (2 * k) + (adc >= EYTZ_AT_IDX(k));
+    }}
+
+    // remove the trailing right turns and the last left turn to get the
+    // first table point above the ADC value, and look up its segment.
+    // entry 0 is used when no point is above the ADC value
+    while (k & 1)
+    {{
+        k >>= 1;
+    }}
+    k >>= 1;
+    uint16_t idx = EYTZ_SEG_AT_IDX(k);
+
+{:s}}}
 """)
 
-# find thermistor resistance at a given temperature
-def temp_to_R(r0, t0, beta, temp):
-    expo = (1.0 / temp) - (1.0 / t0)
-    expo *= beta
-    rout = r0 * math.exp(expo)
+branchless_function_definition = (
+"""// Calculate temperature using lookup table.
+// See header file for API description
+int16_t adc_to_temp(uint16_t adc)
+{{
+    // find the segment by counting the table points that are at or below
+    // the ADC value, without any branches. the first and last table points
+    // are not counted, so values outside the table use the end segments
+    uint16_t idx = {:s};
+
+{:s}}}
+""")
+
+unrolled_function_definition = (
+"""// Calculate temperature using lookup table.
+// See header file for API description
+int16_t adc_to_temp(uint16_t adc)
+{{
+    // the table search is unrolled into a tree of compares, and the
+    // interpolation for each segment uses constants
+{:s}}}
+""")
+
+# find the Eytzinger (breadth first) order of a sorted list of n keys. the
+# returned list has the sorted position of the key for each node k, with
+# the root at k=1 and children at 2k and 2k+1. node 0 is not used
+def eytzinger_order(n):
+    order = [0] * (n + 1)
+    sorted_pos = 0
+    stack = []
+    k = 1
+    # iterative in-order walk of the implicit tree
+    while stack or k <= n:
+        if k <= n:
+            stack.append(k)
+            k = 2 * k
+        else:
+            k = stack.pop()
+            order[k] = sorted_pos
+            sorted_pos += 1
+            k = 2 * k + 1
+    return order
+
+# generate an unrolled binary search, as a tree of if/else, that selects the
+# table segment in the range [lo, hi] for the ADC value. each leaf of the
+# tree is the interpolation for one segment with all the table values filled
+# in as constants, given in leaves as (comment, expression). the outermost
+# segments are also used for values outside the table
+def search_tree(adc_table, leaves, lo, hi, indent):
+    pad = " " * indent
+    if lo == hi:
+        return "{0:s}// [{1:d}] {2:s}\n{0:s}return {3:s};\n".format(pad, lo, *leaves[lo])
+    mid = (lo + hi) // 2
+    return ("{0:s}if (adc < {1:d})\n{0:s}{{\n{2:s}{0:s}}}\n"
+            "{0:s}else\n{0:s}{{\n{3:s}{0:s}}}\n".format(
+                pad, adc_table[mid + 1],
+                search_tree(adc_table, leaves, lo, mid, indent + 4),
+                search_tree(adc_table, leaves, mid + 1, hi, indent + 4)))
+
+# The numeric helpers below work on either scalars or numpy arrays, so
+# a whole table can be computed with one call.
+
+# find thermistor resistance at a given temperature. the temperature is
+# passed as its inverse, 1/temp. beta_inv_t0 is beta/t0 for the nominal
+# temperature t0, which is the same for every call so it is computed once
+# by the caller
+def temp_to_R(r0, beta, beta_inv_t0, inv_temp):
+    rout = r0 * np.exp(beta * inv_temp - beta_inv_t0)
     return rout
 
 # find ADC counts for a given thermistor resistance
@@ -232,61 +444,567 @@ def R_to_counts(rtherm, rpd, rez):
     counts = rez * rpd / (rtherm + rpd)
     return counts
 
-parser = argparse.ArgumentParser(description="Generate Thermistor Lookup Table")
-parser.add_argument("jsonfile", help="JSON file with parameters")
-args = parser.parse_args()
-
-# read the json file and convert fields to variables
-with open(args.jsonfile, "r") as jsonfile:
-    parms = json.load(jsonfile)
-    Tstart = parms['Tstart']
-    Tstop = parms['Tstop']
-    Tstep = parms['Tstep']
-    Tnominal = parms['Tnominal']
-    Rnominal = parms['Rnominal']
-    Rpulldown = parms['Rpulldown']
-    beta = parms['beta']
-    counts = parms['counts']
-    board = parms['board']
-    thermistor = parms['thermistor']
-
-    # fill in the variable data in the parameters comment block
-    rendered_parms_block = parms_block.format(str(datetime.datetime.now()),
-        args.jsonfile, board, thermistor,
-        Tstart, Tstop, Tstep, Tnominal, Rnominal, Rpulldown, beta, counts)
-
-    # generate the header file. no other calculation needed
-    with open("thermistor_table.h", "wt") as hfile:
-        hfile.write(license_block.format(datetime.date.today().year))
-        hfile.write(header_open)
-        hfile.write(rendered_parms_block)
-        hfile.write(function_declaration)
-        hfile.write(header_close)
-
-    # generate the start of the C source file
-    with open("thermistor_table.c", "wt") as cfile:
-        cfile.write(license_block.format(datetime.date.today().year))
-        cfile.write("#include <stdint.h>\n\n")
-        cfile.write(rendered_parms_block)
-        cfile.write("static const uint16_t therm_table[] =\n{\n")
-
-        # generate the lookup table contents as C array
-        idx = 0
-        for temp in range(Tstart, Tstop, Tstep):
-            newr = temp_to_R(Rnominal, Tnominal+273, beta, temp+273)
-            adc = R_to_counts(newr, Rpulldown, counts)
-            cfile.write("   {:4d}, // [{:2d}] C={:2d} R={:d}\n".format(
-                int(round(adc)), idx, int(round(temp)), int(round(newr))))
-            idx += 1
-        cfile.write("};\n\n")
-
-        # generate the C macros used by the function
-        if Tstart == 0:
-            cfile.write("#define T_AT_IDX(idx) ((idx) * {:d})\n".format(Tstep))
+# get the array versions of the numeric helpers, for scripts that import
+# this file to compute many tables. numba is optional. when it is installed
+# the helpers are compiled to run in parallel, otherwise the numpy versions
+# are used. numba is only imported and the helpers compiled on the first
+# call, so the command line does not pay for it
+@functools.lru_cache(maxsize=None)
+def array_helpers():
+    try:
+        from numba import njit, prange
+    except ImportError:
+        def temp_to_R_np(r0, t0, beta, temps):
+            return temp_to_R(r0, beta, beta / t0, 1.0 / temps)
+        return temp_to_R_np, R_to_counts
+
+    @njit(parallel=True, cache=True, fastmath=True)
+    def temp_to_R_par(r0, t0, beta, temps):
+        beta_inv_t0 = beta / t0
+        rout = np.empty(temps.shape[0])
+        for idx in prange(temps.shape[0]):
+            rout[idx] = r0 * np.exp(beta / temps[idx] - beta_inv_t0)
+        return rout
+
+    @njit(parallel=True, cache=True, fastmath=True)
+    def R_to_counts_par(rtherms, rpd, rez):
+        counts = np.empty(rtherms.shape[0])
+        for idx in prange(rtherms.shape[0]):
+            counts[idx] = rez * rpd / (rtherms[idx] + rpd)
+        return counts
+
+    return temp_to_R_par, R_to_counts_par
+
+# find thermistor resistance for an array of temperatures, in parallel
+def temp_to_R_arr(r0, t0, beta, temps):
+    return array_helpers()[0](r0, t0, beta, temps)
+
+# find ADC counts for an array of thermistor resistances, in parallel
+def R_to_counts_arr(rtherms, rpd, rez):
+    return array_helpers()[1](rtherms, rpd, rez)
+
+# find thermistor temperature for a given resistance (inverse of temp_to_R)
+def R_to_temp(r0, t0, beta, rtherm):
+    tout = 1.0 / ((1.0 / t0) + (np.log(rtherm / r0) / beta))
+    return tout
+
+# find thermistor resistance for given ADC counts (inverse of R_to_counts)
+def counts_to_R(adc, rpd, rez):
+    rtherm = rpd * (rez - adc) / adc
+    return rtherm
+
+# evaluate the fixed point polynomial for an array of ADC values, the same
+# way as the generated C code. returns the Horner result before the final
+# rounding shift, and the largest magnitude of any intermediate value, which
+# must fit in a signed 32-bit value
+def poly_horner_fixed(fixed, adcs, adc_bits):
+    temp = np.full(adcs.shape, fixed[0], dtype=np.int64)
+    peak = abs(fixed[0])
+    for coeff in fixed[1:]:
+        prod = temp * adcs
+        temp = (prod >> adc_bits) + coeff
+        peak = max(peak, int(np.max(np.abs(prod))), int(np.max(np.abs(temp))))
+    return temp, peak
+
+# find the reciprocal and shift for a segment range. the reciprocal is
+# rounded up, and (numerator * recip) >> rshift matches the integer division
+# numerator / rng for every numerator up to x_max when
+# x_max * (recip * rng - 2^rshift) < 2^rshift. x_max is the largest
+# numerator inside the segment. the 16-bit reciprocal must also keep the
+# product with the largest possible numerator, for values outside the table,
+# in a signed 32-bit value. returns None if there is no such reciprocal. the
+# wide reciprocal is 32 bits and the product is 64 bits, which is always
+# exact with a large enough shift
+def segment_recip(rng, Tstep, counts, wide=False):
+    x_max = Tstep * rng + (rng >> 1)
+    numerator = counts * Tstep + (rng >> 1)
+    if wide:
+        rshift = (x_max * rng).bit_length()
+        recip = -(-(1 << rshift) // rng)
+        if recip > 0xFFFFFFFF or numerator * recip >= 1 << 63:
+            return None
+        return recip, rshift
+    for rshift in range(RECIP_SHIFT_MAX, -1, -1):
+        recip = -(-(1 << rshift) // rng)
+        if recip > 0xFFFF or numerator * recip >= 1 << 31:
+            continue
+        if x_max * (recip * rng - (1 << rshift)) < 1 << rshift:
+            return recip, rshift
+    return None
+
+# Tables are placed in flash (program memory) without a copy in RAM. On
+# Harvard architecture MCUs this needs a compiler specific qualifier, and on
+# AVR the table must also be read with special functions.
+TARGETS = ("generic", "avr", "8051", "arm")
+
+TARGET_INCLUDES = {
+    "generic": "",
+    "avr": "#include <avr/pgmspace.h>\n",
+    "8051": "",
+    "arm": "",
+}
+
+AVR_PGM_READ = {
+    "uint8_t": "pgm_read_byte",
+    "int16_t": "pgm_read_word",
+    "uint16_t": "pgm_read_word",
+    "int32_t": "pgm_read_dword",
+    "uint32_t": "pgm_read_dword",
+}
+
+# generate the start of a constant table declaration for the target
+def table_declaration(target, ctype, name):
+    if target == "avr":
+        return "static const {:s} {:s}[] PROGMEM =\n{{\n".format(ctype, name)
+    elif target == "8051":
+        return "static const __code {:s} {:s}[] =\n{{\n".format(ctype, name)
+    return "static const {:s} {:s}[] =\n{{\n".format(ctype, name)
+
+# generate a macro that reads one entry of a constant table for the target
+def table_read_macro(target, macro, ctype, name):
+    if target == "avr":
+        return "#define {:s}(idx) (({:s}){:s}(&{:s}[idx]))\n".format(
+            macro, ctype, AVR_PGM_READ[ctype], name)
+    return "#define {:s}(idx) ({:s}[idx])\n".format(macro, name)
+
+# get the time once, so that both generated files have the same timestamp.
+# the license block only depends on the year, so it is rendered once here
+NOW = datetime.datetime.now()
+YEAR = NOW.year
+rendered_license = license_block.format(YEAR)
+
+# generate the header and source file for one json file, into outdir.
+# args are the parsed command line options
+def process(jsonpath, args, outdir="."):
+    # read the json file and convert fields to variables
+    with open(jsonpath, "r") as jsonfile:
+        parms = json.load(jsonfile)
+        Tstart = parms['Tstart']
+        Tstop = parms['Tstop']
+        Tstep = parms['Tstep']
+        Tnominal = parms['Tnominal']
+        Rnominal = parms['Rnominal']
+        Rpulldown = parms['Rpulldown']
+        beta = parms['beta']
+        counts = parms['counts']
+        board = parms['board']
+        thermistor = parms['thermistor']
+
+        # this term of the beta equation only depends on the nominal
+        # temperature, so compute it once for the whole table
+        beta_inv_t0 = beta / (Tnominal + 273)
+
+        # fill in the variable data in the parameters comment block
+        rendered_parms_block = render_parms(str(NOW),
+            jsonpath, board, thermistor,
+            Tstart, Tstop, Tstep, Tnominal, Rnominal, Rpulldown, beta, counts)
+
+        # the output files are built as a list of fragments and then each file
+        # is written in one go
+        header_parts = [rendered_license, header_open, rendered_parms_block,
+                        function_declaration]
+        if args.emit_testvec:
+            header_parts.append(selftest_declaration)
+        header_parts.append(header_close)
+
+        # ADC values for the test vectors, spread over the table range.
+        # each mode below also computes test_out, what the generated
+        # function returns for these values
+        if args.emit_testvec:
+            Tlast = Tstart + ((Tstop - Tstart - 1) // Tstep) * Tstep
+            endr = temp_to_R(Rnominal, beta, beta_inv_t0, 1.0 / (np.array([Tstart, Tlast]) + 273))
+            test_lo, test_hi = R_to_counts(endr, Rpulldown, counts)
+            test_adcs = np.unique(np.rint(np.linspace(test_lo, test_hi, TESTVEC_POINTS))).astype(np.int64)
+        source_parts = [rendered_license, "#include <stdint.h>\n",
+                        TARGET_INCLUDES[args.target], "\n", rendered_parms_block]
+
+        # polynomial fit to the thermistor curve over the table temperature
+        # range. there is no table at all, and run-time is a few multiplies
+        # and adds
+        if args.poly is not None:
+            # fit against every ADC value in the temperature range. the ADC
+            # value is scaled to a fraction in [0, 1) so the coefficients stay
+            # in a reasonable range for fixed point
+            adc_bits = counts.bit_length()
+            endr = temp_to_R(Rnominal, beta, beta_inv_t0, 1.0 / (np.array([Tstart, Tstop]) + 273))
+            adc_lo, adc_hi = np.rint(R_to_counts(endr, Rpulldown, counts)).astype(np.int32).tolist()
+            adcs = np.arange(adc_lo, adc_hi + 1, dtype=np.float64)
+            temps = R_to_temp(Rnominal, Tnominal+273, beta, counts_to_R(adcs, Rpulldown, counts)) - 273
+            coeffs = np.polyfit(adcs / (1 << adc_bits), temps, args.poly)
+            fit_err = np.max(np.abs(np.polyval(coeffs, adcs / (1 << adc_bits)) - temps))
+
+            # find the largest intermediate Horner value over the fit range,
+            # as a multiple of the scale 2^shift. the input is clamped to the
+            # fit range, so no other ADC values need to be checked. the
+            # products with the ADC value are the largest, so start with the
+            # largest shift where they fit in a signed 32-bit value. the
+            # rounding of the scaled coefficients can still push a value
+            # over, so check the actual fixed point values and lower the
+            # shift until they fit
+            iadcs = adcs.astype(np.int64)
+            horner = np.full(adcs.shape, coeffs[0])
+            peak = abs(coeffs[0])
+            for coeff in coeffs[1:]:
+                peak = max(peak, np.max(np.abs(horner * adcs)))
+                horner = horner * (adcs / (1 << adc_bits)) + coeff
+                peak = max(peak, np.max(np.abs(horner)))
+            shift = min(30, int(np.floor(np.log2(((1 << 31) - 1) / peak))))
+            while shift >= 1:
+                fixed = np.rint(coeffs * (1 << shift)).astype(np.int64).tolist()
+                fixed_temps, fixed_peak = poly_horner_fixed(fixed, iadcs, adc_bits)
+                if fixed_peak + (1 << (shift - 1)) < (1 << 31):
+                    break
+                shift -= 1
+            if shift < 1:
+                raise ValueError("{:s}: polynomial of degree {:d} does not fit in fixed "
+                                 "point, try a lower degree".format(jsonpath, args.poly))
+
+            # the error of the generated function, including the fixed point
+            # math and rounding of the result to whole degrees. the rounding
+            # alone can add half a degree to the fit error, reject the degree
+            # if the fixed point math adds more than that
+            out_temps = (fixed_temps + (1 << (shift - 1))) >> shift
+            out_err = np.max(np.abs(out_temps - temps))
+            if args.emit_testvec:
+                test_out = out_temps[np.clip(test_adcs, adc_lo, adc_hi) - adc_lo]
+            if out_err > fit_err + 0.5 + POLY_ERR_MARGIN:
+                raise ValueError("{:s}: polynomial of degree {:d} has {:.2f}C error in "
+                                 "fixed point, for a fit error of {:.2f}C, try a lower "
+                                 "degree".format(jsonpath, args.poly, out_err, fit_err))
+
+            source_parts.append("// polynomial fit for ADC {:d} to {:d} ({:d}C to {:d}C),\n"
+                        "// max fit error {:.2f}C, max error of the result {:.2f}C\n".format(
+                            adc_lo, adc_hi, Tstart, Tstop, fit_err, out_err))
+            for power, coeff in zip(range(args.poly, -1, -1), coeffs):
+                source_parts.append("// c{:d} = {:.6e}\n".format(power, coeff))
+            source_parts.append("#define T_ADC_MIN ({:d})\n".format(adc_lo))
+            source_parts.append("#define T_ADC_MAX ({:d})\n".format(adc_hi))
+            source_parts.append("#define T_ADC_BITS ({:d})\n".format(adc_bits))
+            source_parts.append("#define T_POLY_SHIFT ({:d})\n\n".format(shift))
+
+            # the clamps are left out when they can never be true
+            clamps = ""
+            if adc_lo > 0:
+                clamps += poly_clamp_low
+            if adc_hi < 0xFFFF:
+                clamps += poly_clamp_high
+            if clamps:
+                clamps += "\n"
+            horner = "".join(
+                "    temp = ((temp * (int32_t)adc) >> T_ADC_BITS) {:s} {:d}L;\n".format(
+                    "-" if coeff < 0 else "+", abs(coeff))
+                for coeff in fixed[1:])
+            source_parts.append(poly_function_definition.format(
+                clamps, "{:d}L".format(fixed[0]), horner))
+
+        # dense table has a temperature for every possible ADC value, so
+        # there is no search or interpolation at run-time, at the cost of
+        # a much larger table
+        elif args.dense:
+            # pgm_read_word() can only reach the first 64KB of flash
+            if args.target == "avr" and (counts + 1) * 2 > 0x10000:
+                raise ValueError("{:s}: dense table for {:d} counts does not fit in "
+                                 "64KB for avr".format(jsonpath, counts))
+
+            # ADC value at either end of the scale means the thermistor
+            # resistance is infinite or zero. use half a count from the
+            # end instead
+            adcs = np.clip(np.arange(counts + 1, dtype=np.float64), 0.5, counts - 0.5)
+            newr = counts_to_R(adcs, Rpulldown, counts)
+            temps = np.rint(R_to_temp(Rnominal, Tnominal+273, beta, newr) - 273)
+            temps = np.clip(temps, -32768, 32767).astype(np.int32).tolist()
+            if args.emit_testvec:
+                test_out = np.array(temps)[test_adcs]
+            source_parts.append(table_declaration(args.target, "int16_t", "adc_to_temp_table"))
+            for adc in range(0, counts + 1, 8):
+                source_parts.append("   ")
+                for temp in temps[adc:adc + 8]:
+                    source_parts.append(" {:4d},".format(temp))
+                source_parts.append(" // [{:4d}]\n".format(adc))
+            source_parts.append("};\n\n")
+            source_parts.append(table_read_macro(args.target, "TEMP_AT_ADC", "int16_t", "adc_to_temp_table"))
+            source_parts.append("#define T_TABLE_SIZE ({:d})\n\n".format(counts + 1))
+            # the input can only be out of the table if the table is
+            # smaller than the range of uint16_t
+            if counts < 0xFFFF:
+                source_parts.append(dense_function_definition.format(
+                    "adc < T_TABLE_SIZE ? adc : T_TABLE_SIZE - 1"))
+            else:
+                source_parts.append(dense_function_definition.format("adc"))
+
+        else:
+            # compute the lookup table. the whole table is computed at once
+            temps = np.arange(Tstart, Tstop, Tstep)
+            newr = temp_to_R(Rnominal, beta, beta_inv_t0, 1.0 / (temps + 273))
+            adc_table = np.rint(R_to_counts(newr, Rpulldown, counts)).astype(np.int32).tolist()
+            temp_table = temps.tolist()
+            segments = len(adc_table) - 1
+            if segments < 1:
+                raise ValueError("{:s}: the table needs at least two points, check "
+                                 "Tstart, Tstop, and Tstep".format(jsonpath))
+
+            # compute the reciprocal of each segment range as a 16-bit
+            # fixed point value with its own shift. this replaces a run-time
+            # division with a multiply and shift, with the same result as
+            # integer division inside the table. with wide ADCs there may be
+            # no 16-bit reciprocal that is exact, then the whole table uses
+            # 32-bit reciprocals and a 64-bit product
+            ranges = [adc1 - adc0 for adc0, adc1 in zip(adc_table, adc_table[1:])]
+            wide = False
+            pairs = [segment_recip(rng, Tstep, counts) for rng in ranges if rng]
+            if None in pairs:
+                wide = True
+                pairs = [segment_recip(rng, Tstep, counts, wide) for rng in ranges if rng]
+                if None in pairs:
+                    raise ValueError("{:s}: no exact reciprocal for the table segments, "
+                                     "try a smaller Tstep".format(jsonpath))
+            # zero width segment can only be reached by extrapolation, so
+            # treat it as flat
+            pairs = iter(pairs)
+            recips, rshifts = zip(*[next(pairs) if rng else (0, 0) for rng in ranges])
+            recip_type = "uint32_t" if wide else "uint16_t"
+
+            # inside the table the result is the same as integer division.
+            # a zero width segment is flat
+            if args.emit_testvec:
+                test_idx = np.searchsorted(adc_table[1:-1], test_adcs, side="right")
+                test_adc0 = np.array(adc_table)[test_idx]
+                test_rng = np.array(adc_table)[test_idx + 1] - test_adc0
+                test_out = (np.array(temp_table)[test_idx]
+                            + (Tstep * (test_adcs - test_adc0) + (test_rng >> 1))
+                            // np.maximum(test_rng, 1))
+
+            # reduce the slope of each segment, Tstep / range. if every segment
+            # has a whole number slope then the interpolation is exact and
+            # needs no reciprocal at all
+            slopes = [Tstep // math.gcd(Tstep, rng) if rng else 0 for rng in ranges]
+            exact = all(rng == 0 or Tstep % rng == 0 for rng in ranges)
+
+            # when the step is a power of 2, multiply by the step using a shift.
+            # the shift is done unsigned so that it is well defined for
+            # negative values
+            step_shift = Tstep.bit_length() - 1
+            step_is_pow2 = (Tstep & (Tstep - 1)) == 0
+
+            # store the table points in the smallest type that holds the ADC
+            # counts. on an 8-bit MCU with an 8-bit ADC this halves the table
+            # size and the number of loads. the local copy of a point uses
+            # the same type if it is promoted to a signed int, otherwise a
+            # signed type big enough to do the math
+            if counts <= 0xFF:
+                table_type, adc_type, diff_type = "uint8_t", "uint8_t", "int16_t"
+            elif counts <= 0x7FFF:
+                table_type, adc_type, diff_type = "uint16_t", "int16_t", "int16_t"
+            elif counts <= 0xFFFF:
+                table_type, adc_type, diff_type = "uint16_t", "int32_t", "int32_t"
+            else:
+                table_type, adc_type, diff_type = "uint32_t", "int32_t", "int32_t"
+
+            # small tables that are unrolled do not need any table in memory.
+            # the table points are listed in a comment for reference
+            small = segments <= SMALL_TABLE_SEGMENTS
+            unrolled = small and args.target in SMALL_CORE_TARGETS
+            eytzinger = not small and args.target not in SMALL_CORE_TARGETS
+            if unrolled:
+                source_parts.append("// Lookup table points:\n")
+                for idx, (adc, temp, rtherm) in enumerate(zip(adc_table, temp_table, newr.tolist())):
+                    source_parts.append("//  [{:2d}] ADC={:4d} C={:2d} R={:d}\n".format(
+                        idx, adc, temp, int(round(rtherm))))
+                source_parts.append("\n")
+
+            # the table data is emitted as separate arrays for each field instead
+            # of an array of structs. the search only reads the ADC values, so
+            # those are kept together in one small array
+            else:
+                source_parts.append(
+                    "// Lookup table data is kept in separate arrays. The segment search\n"
+                    "// only reads {:s}, and the data for the\n"
+                    "// segment is read once after the search.\n\n".format(
+                        "therm_eytz[] and therm_eytz_seg[]" if eytzinger else "therm_adc[]"))
+                source_parts.append(table_declaration(args.target, table_type, "therm_adc"))
+                for idx, (adc, temp, rtherm) in enumerate(zip(adc_table, temp_table, newr.tolist())):
+                    source_parts.append("   {:4d}, // [{:2d}] C={:2d} R={:d}\n".format(
+                        adc, idx, temp, int(round(rtherm))))
+                source_parts.append("};\n\n")
+                if exact:
+                    source_parts.append(table_declaration(args.target, "uint16_t", "therm_slope"))
+                    for seg, (slope, rng) in enumerate(zip(slopes, ranges)):
+                        source_parts.append("   {:5d}, // [{:2d}] range={:d}\n".format(slope, seg, rng))
+                    source_parts.append("};\n\n")
+                else:
+                    source_parts.append(table_declaration(args.target, recip_type, "therm_recip"))
+                    for seg, (recip, rng) in enumerate(zip(recips, ranges)):
+                        source_parts.append("   {:5d}, // [{:2d}] range={:d}\n".format(recip, seg, rng))
+                    source_parts.append("};\n\n")
+                    source_parts.append(table_declaration(args.target, "uint8_t", "therm_rshift"))
+                    for seg, rshift in enumerate(rshifts):
+                        source_parts.append("   {:2d}, // [{:2d}]\n".format(rshift, seg))
+                    source_parts.append("};\n\n")
+
+                # for the Eytzinger search, the interior table points are
+                # stored again in breadth first order, with the segment for
+                # each one. the first and last points are left out so that
+                # values outside the table use the end segments
+                if eytzinger:
+                    order = eytzinger_order(segments - 1)
+                    seg_type = "uint8_t" if segments <= 0x100 else "uint16_t"
+                    source_parts.append(table_declaration(args.target, table_type, "therm_eytz"))
+                    source_parts.append("      0, // [ 0] not used\n")
+                    for k, pos in enumerate(order[1:], 1):
+                        source_parts.append("   {:4d}, // [{:2d}] point {:d}\n".format(
+                            adc_table[pos + 1], k, pos + 1))
+                    source_parts.append("};\n\n")
+                    source_parts.append(table_declaration(args.target, seg_type, "therm_eytz_seg"))
+                    source_parts.append("   {:4d}, // [ 0] above all points\n".format(segments - 1))
+                    for k, pos in enumerate(order[1:], 1):
+                        source_parts.append("   {:4d}, // [{:2d}]\n".format(pos, k))
+                    source_parts.append("};\n\n")
+
+                # generate the C macros used by the function
+                if Tstart == 0 and step_is_pow2:
+                    source_parts.append("#define T_AT_IDX(idx) ((idx) << {:d})\n".format(step_shift))
+                elif Tstart == 0:
+                    source_parts.append("#define T_AT_IDX(idx) ((idx) * {:d})\n".format(Tstep))
+                else:
+                    source_parts.append("#define T_AT_IDX(idx) ({:d} + ((idx) * {:d}))\n".format(Tstart, Tstep))
+                source_parts.append("#define T_LAST_IDX ({:d})\n".format(segments))
+                source_parts.append(table_read_macro(args.target, "ADC_AT_IDX", table_type, "therm_adc"))
+                if eytzinger:
+                    source_parts.append("#define T_EYTZ_SIZE ({:d})\n".format(segments - 1))
+                    source_parts.append(table_read_macro(args.target, "EYTZ_AT_IDX", table_type, "therm_eytz"))
+                    source_parts.append(table_read_macro(args.target, "EYTZ_SEG_AT_IDX", seg_type, "therm_eytz_seg"))
+                if exact:
+                    source_parts.append(table_read_macro(args.target, "SLOPE_AT_IDX", "uint16_t", "therm_slope"))
+                else:
+                    source_parts.append(table_read_macro(args.target, "RECIP_AT_IDX", recip_type, "therm_recip"))
+                    source_parts.append(table_read_macro(args.target, "RSHIFT_AT_IDX", "uint8_t", "therm_rshift"))
+
+            source_parts.append("#define T_STEP ({:d})\n".format(Tstep))
+            if step_is_pow2:
+                source_parts.append(
+                    "#define T_STEP_MUL(x) ((int32_t)((uint32_t)(x) << {:d}))\n\n".format(step_shift))
+            else:
+                source_parts.append("#define T_STEP_MUL(x) ((x) * T_STEP)\n\n")
+
+            # generate the C function into the source file. small tables are
+            # either unrolled into a fixed tree of compares, with the
+            # interpolation for each segment as constants, or use a branchless
+            # sum of compares. larger tables use an Eytzinger search, or a
+            # binary search loop on MCUs without a cache
+            interpolate = interpolate_slope if exact else interpolate_recip
+            interpolate = interpolate.format(adc_type=adc_type, diff_type=diff_type,
+                                             recip_mul=recip_mul_wide if wide else recip_mul)
+            if unrolled:
+                leaves = []
+                for seg in range(segments):
+                    comment = "{:d}C to {:d}C".format(temp_table[seg], temp_table[seg] + Tstep)
+                    if exact:
+                        expr = "{:d} + ((int16_t)adc - {:d}) * {:d}".format(
+                            temp_table[seg], adc_table[seg], slopes[seg])
+                    elif wide:
+                        expr = "{:d} + (int16_t)(((int64_t)(T_STEP_MUL((int32_t)adc - {:d}) + {:d}) * {:d}LL) >> {:d})".format(
+                            temp_table[seg], adc_table[seg], ranges[seg] >> 1,
+                            recips[seg], rshifts[seg])
+                    else:
+                        expr = "{:d} + (int16_t)(((T_STEP_MUL((int32_t)adc - {:d}) + {:d}) * {:d}L) >> {:d})".format(
+                            temp_table[seg], adc_table[seg], ranges[seg] >> 1,
+                            recips[seg], rshifts[seg])
+                    leaves.append((comment, expr))
+                source_parts.append(unrolled_function_definition.format(
+                    search_tree(adc_table, leaves, 0, segments - 1, 4)))
+            elif small:
+                compares = "\n                 + ".join(
+                    "(adc >= {:d})".format(adc) for adc in adc_table[1:-1])
+                source_parts.append(branchless_function_definition.format(
+                    compares or "0", interpolate))
+            elif eytzinger:
+                source_parts.append(eytzinger_function_definition.format(interpolate))
+            else:
+                source_parts.append(function_definition.format(interpolate))
+
+        # write the generated files
+        with open(os.path.join(outdir, "thermistor_table.h"), "wt") as hfile:
+            hfile.write("".join(header_parts))
+        with open(os.path.join(outdir, "thermistor_table.c"), "wt") as cfile:
+            cfile.write("".join(source_parts))
+
+        # generate the test vector source file. the expected result for each
+        # test value is what the generated function returns, so the check is
+        # exact on correct code. the temperature from the thermistor equation
+        # is computed in floating point here, and listed as Q8 fixed point in
+        # a comment for reference
+        if args.emit_testvec:
+            test_temps = R_to_temp(Rnominal, Tnominal+273, beta,
+                                   counts_to_R(test_adcs, Rpulldown, counts)) - 273
+            test_q8 = np.rint(test_temps * 256).astype(np.int64).tolist()
+            test_out = test_out.astype(np.int64).tolist()
+            test_adcs = test_adcs.tolist()
+
+            testvec_parts = [rendered_license, "#include <stdint.h>\n",
+                             TARGET_INCLUDES[args.target],
+                             "#include \"thermistor_table.h\"\n\n",
+                             "// Test vectors for adc_to_temp(), from {:s}\n\n".format(jsonpath)]
+            testvec_parts.append(table_declaration(args.target, "uint16_t", "therm_testvec_adc"))
+            for adc in test_adcs:
+                testvec_parts.append("   {:5d},\n".format(adc))
+            testvec_parts.append("};\n\n")
+            testvec_parts.append(table_declaration(args.target, "int16_t", "therm_testvec_expect"))
+            for adc, out, q8 in zip(test_adcs, test_out, test_q8):
+                testvec_parts.append("   {:4d}, // ADC={:d} equation C={:.2f} Q8={:d}\n".format(
+                    out, adc, q8 / 256, q8))
+            testvec_parts.append("};\n\n")
+            testvec_parts.append("#define T_TESTVEC_COUNT ({:d})\n".format(len(test_adcs)))
+            testvec_parts.append(table_read_macro(args.target, "TESTVEC_ADC_AT_IDX", "uint16_t", "therm_testvec_adc"))
+            testvec_parts.append(table_read_macro(args.target, "TESTVEC_EXPECT_AT_IDX", "int16_t", "therm_testvec_expect"))
+            testvec_parts.append("\n// allowed difference from the expected result, in degrees C\n")
+            testvec_parts.append("#ifndef THERM_TESTVEC_TOL\n#define THERM_TESTVEC_TOL (1)\n#endif\n\n")
+            testvec_parts.append(testvec_function_definition)
+            with open(os.path.join(outdir, "thermistor_testvec.c"), "wt") as tfile:
+                tfile.write("".join(testvec_parts))
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Thermistor Lookup Table")
+    parser.add_argument("jsonfile", nargs="+", help="JSON file(s) with parameters")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--dense", action="store_true",
+                      help="generate a table with the temperature for every ADC value")
+    mode.add_argument("--poly", type=int, metavar="N",
+                      help="generate a polynomial of degree N instead of a table")
+    parser.add_argument("--target", choices=TARGETS, default="generic",
+                        help="MCU type, used to keep tables in flash (default: generic)")
+    parser.add_argument("--emit-testvec", action="store_true",
+                        help="also generate thermistor_testvec.c with a self-test function")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of json files to process in parallel (default: 1)")
+    args = parser.parse_args()
+    if args.poly is not None and args.poly < 0:
+        parser.error("--poly degree must be 0 or more")
+
+    # a single json file is generated into the current directory. for more
+    # than one, each gets a directory named after the json file
+    if len(args.jsonfile) == 1:
+        outdirs = ["."]
+    else:
+        outdirs = [os.path.splitext(os.path.basename(path))[0] for path in args.jsonfile]
+        if len(set(outdirs)) != len(outdirs):
+            parser.error("json file names must be unique when generating more than one")
+        for outdir in outdirs:
+            os.makedirs(outdir, exist_ok=True)
+
+    # all the files are processed in this one python process, or spread
+    # over a pool of worker processes
+    try:
+        if args.jobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+                jobs = [executor.submit(process, path, args, outdir)
+                        for path, outdir in zip(args.jsonfile, outdirs)]
+                for job in jobs:
+                    job.result()
         else:
-            cfile.write("#define T_AT_IDX(idx) ({:d} + ((idx) * {:d}))\n".format(Tstart, Tstep))
-        cfile.write("#define T_STEP ({:d})\n".format(Tstep))
-        cfile.write("#define T_LAST_IDX ({:d})\n\n".format(idx - 1))
+            for path, outdir in zip(args.jsonfile, outdirs):
+                process(path, args, outdir)
+    except ValueError as err:
+        parser.error(str(err))
 
-        # generate the C function into the source file
-        cfile.write(function_definition)
+if __name__ == "__main__":
+    main()